@@ -6,49 +6,216 @@
 
 
 import argparse
-import copy
-import gc
-import json
+import asyncio
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ProcessPoolExecutor
 import os
-from typing import Dict, List, Tuple
+from typing import Any, BinaryIO, Dict, List, Set, Tuple
+from urllib.robotparser import RobotFileParser
 
-from bs4 import BeautifulSoup
+from aiohttp_retry import RetryClient
+import orjson
+from selectolax.lexbor import LexborHTMLParser
 from tqdm import tqdm
 
-from download import get_article
+from download import bounded, create_session, get_article, get_robots
+from download import max_concurrent_requests, user_agent
 
 
-def explore_related(
+num_workers = 64
+related_terms_css = 'a.related-terms__title.mntl-text-link'
+related_articles_css = 'a.related-articles__link span.card__title-text'
+related_links_css = f'{related_terms_css}, {related_articles_css}'
+parse_cache_size = 8192
+parse_cache: OrderedDict[str, asyncio.Future] = OrderedDict()
+downloads: Dict[str, asyncio.Future] = dict()
+
+
+def stream_dump_dict(d: Dict[str, Any], f: BinaryIO) -> None:
+	'''
+	Write a dictionary to file as a JSON object one entry at a time, so
+		that only a single entry is serialized in memory at once. Sets
+		are written as lists.
+	@param: d (Dict[str, Any]), the dictionary to write.
+	@param: f (BinaryIO), the file (opened in binary mode) to write to.
+	@return: returns nothing.
+	'''
+	f.write(b"{")
+	for index, (key, value) in enumerate(d.items()):
+		if index > 0:
+			f.write(b",")
+		f.write(orjson.dumps(key))
+		f.write(b":")
+		f.write(orjson.dumps(value, default=list))
+	f.write(b"}")
+
+
+def scan_existing_files(data_folder: str) -> Set[str]:
+	'''
+	Collect the paths of all files in the subfolders of the data 
+		folder. Paths are normalized so that they can be compared 
+		against the paths in the article map.
+	@param: data_folder (str), the path to the data folder.
+	@return: returns the set of (normalized) paths to each file.
+	'''
+	existing_files = set()
+	with os.scandir(data_folder) as folders:
+		for folder in folders:
+			if not folder.is_dir():
+				continue
+
+			with os.scandir(folder.path) as entries:
+				existing_files.update(
+					os.path.normpath(entry.path) 
+					for entry in entries 
+					if entry.is_file()
+				)
+
+	return existing_files
+
+
+def parse_outbound_links(article_path: str) -> List[Tuple[str, str, bool]]:
+	'''
+	Parse the local copy of an article for its related terms and 
+		articles. Has no shared state so that it can be run in a 
+		separate process.
+	@param: article_path (str), the path to the local copy of the 
+		article.
+	@return: returns a list of (name, url, is_term) tuples for each 
+		unique outbound link of the article.
+	'''
+	# Load local copy of the article and isolate all related terms and
+	# articles to the article. The raw bytes are handed straight to the
+	# parser rather than being decoded to a str first.
+	with open(article_path, "rb") as f:
+		tree = LexborHTMLParser(f.read())
+
+	# List of outbound links for the current article (related terms and 
+	# articles). Links are deduplicated by name as they are found.
+	outbound_links = list()
+	seen_names = set()
+
+	# Isolate related terms and articles in a single pass over the 
+	# tree. Related terms match on the link itself while related 
+	# articles match on the title text, so walk up to the enclosing 
+	# link for the href.
+	for node in tree.css(related_links_css):
+		is_term = node.tag == 'a'
+		link_node = node
+		while link_node is not None and link_node.tag != 'a':
+			link_node = link_node.parent
+
+		if link_node is None or not link_node.attributes.get('href'):
+			continue
+
+		name = node.text()
+		if name in seen_names:
+			continue
+
+		seen_names.add(name)
+		outbound_links.append(
+			(name, link_node.attributes.get('href'), is_term)
+		)
+
+	return outbound_links
+
+
+async def parse_cached(
+	pool: ProcessPoolExecutor, 
+	article_path: str
+) -> List[Tuple[str, str, bool]]:
+	'''
+	Parse the local copy of an article in the process pool, memoized by
+		path in a bounded least recently used cache. The pending parse 
+		is cached as soon as it is submitted so that concurrent callers
+		for the same file share a single parse.
+	@param: pool (ProcessPoolExecutor), the process pool that articles
+		are parsed in.
+	@param: article_path (str), the path to the local copy of the 
+		article.
+	@return: returns a list of (name, url, is_term) tuples for each 
+		unique outbound link of the article.
+	'''
+	article_file = os.path.normpath(article_path)
+	future = parse_cache.get(article_file)
+	if future is None:
+		loop = asyncio.get_running_loop()
+		future = loop.run_in_executor(
+			pool, 
+			parse_outbound_links, 
+			article_path
+		)
+		parse_cache[article_file] = future
+		if len(parse_cache) > parse_cache_size:
+			parse_cache.popitem(last=False)
+	else:
+		parse_cache.move_to_end(article_file)
+
+	try:
+		return await asyncio.shield(future)
+	except Exception:
+		# Don't cache failed parses.
+		if parse_cache.get(article_file) is future:
+			del parse_cache[article_file]
+		raise
+
+
+async def explore_related(
+	queue: asyncio.Queue,
+	session: RetryClient,
+	sem: asyncio.Semaphore,
+	pool: ProcessPoolExecutor,
+	robots: RobotFileParser,
 	article_map: Dict[str, Dict[str, str]], 
-	# graph: Dict[str, List[Tuple[str, str]]], 
+	graph: Dict[str, Set[str]], 
+	visited: Dict[str, int],
+	existing_files: Set[str],
 	article: str, 
 	article_url: str, 
 	is_term: bool = True,
 	depth: int = 1, 
 	restart: bool = False
-) -> Tuple[Dict[str, Dict[str, str]], Dict[str, List[Tuple[str, str]]]]:
+) -> int:
 	'''
 	Explore related terms and articles that are connected to the 
-		current term/article.
+		current term/article. Related terms and articles are pushed 
+		onto the queue to be explored in turn, unless they have already
+		been queued with at least as much depth left.
+	@param: queue (asyncio.Queue), the queue of (article, url, is_term,
+		depth) tuples left to explore.
+	@param: session (RetryClient), the shared HTTP session.
+	@param: sem (asyncio.Semaphore), the semaphore bounding the number
+		of concurrent requests.
+	@param: pool (ProcessPoolExecutor), the process pool that articles
+		are parsed in.
+	@param: robots (RobotFileParser), the parsed robots.txt that 
+		downloads must be allowed by.
 	@param: article_map (Dict[str, Dict[str, str]]), the mapping for
 		each article/entry and its associated local copy and url on 
 		investopedia.
-	@param: graph (Dict[str, List[Tuple[str, str]]]), the mapping for each 
+	@param: graph (Dict[str, Set[str]]), the mapping for each 
 		article/entry and its associated related terms and articles.
+	@param: visited (Dict[str, int]), the articles that have already
+		been queued for exploration, mapped to the largest depth they
+		were queued with.
+	@param: existing_files (Set[str]), the (normalized) paths of the
+		articles that exist locally.
 	@param: article (str), the target article of interest.
 	@param: article_url (str), the URL associated with the article of
 		interest.
+	@param: is_term (bool), whether the article of interest is a term 
+		(as opposed to an article). Default is True.
 	@param: depth (int), the level of depth that is to be explored in
 		this graph. Default is 1.
 	@param: restart (bool). whether to re-scrape the article of 
 		interest and update its local copy with the new data.
-	@return: returns a tuple containing two dictionaries serving as 
-		submappings that will be used to update the reference 
-		article_map and graphs respectively.
+	@return: returns the number of articles pushed onto the queue. The
+		article_map and graph are updated in place.
 	'''
-	# Return submaps.
-	article_submap = dict()
-	graph_submap = dict()
+	# Skip this entry if the article has since been queued again with
+	# more depth left (that entry will explore it instead).
+	if depth < visited.get(article, depth):
+		return 0
 
 	# Folder path for related articles.
 	related_articles_folder = f"./data/{'term' if is_term else 'article'}/"
@@ -60,8 +227,15 @@ def explore_related(
 	# Isolate whether the current article of interest is already 
 	# scraped. Scrape the data if that is not the case OR if the 
 	# restart flag is true.
-	article_unseen = article not in list(article_map.keys())
+	article_unseen = article not in article_map
 	if restart or article_unseen:
+		# Only download the article if robots.txt allows it. Unseen 
+		# articles that are disallowed are skipped entirely while known
+		# articles fall back on their local copy.
+		allowed = robots.can_fetch(user_agent, article_url)
+		if article_unseen and not allowed:
+			return 0
+
 		# Isolate the necessary path for the local copy of the 
 		# article.
 		if article_unseen:
@@ -73,131 +247,264 @@ def explore_related(
 				article_cleaned + ".html"
 			)
 
-			# Update the article submap (and the main article map) for 
-			# this entry.
-			article_data = {
+			# Update the article map for this entry.
+			article_map[article] = {
 				"path": article_path,
 				"link": article_url
 			}
-			article_submap[article] = article_data
-			article_map[article] = article_data
 		else:
 			# Read the path from the article map.
 			article_path = article_map[article]["path"]
 
-		# Download the article.
-		get_article(article_url, article_path)
+		# Download the article, unless it has already been started by 
+		# an earlier entry for it. This is skipped if the article 
+		# already exists from a prior run (unless restarting) or is 
+		# unchanged since it was downloaded.
+		article_file = os.path.normpath(article_path)
+		if allowed and article_file not in downloads and (
+			restart or article_file not in existing_files
+		):
+			downloads[article_file] = asyncio.ensure_future(
+				bounded(
+					sem, 
+					get_article(
+						session, 
+						article_url, 
+						article_path, 
+						restart, 
+						article_map[article].get("etag")
+					)
+				)
+			)
 
 	# Isolate the local copy of the article.
-	# if article_unseen:
-	# 	article_path = article_submap[article]["path"]
-	# else:
-	# 	article_path = article_map[article]["path"]
 	article_path = article_map[article]["path"]
-
-	# Skip this level if the local copy of the article is not 
+	article_file = os.path.normpath(article_path)
+
+	# Wait on the download of the article (if any). It may have been 
+	# started by an earlier entry for the same article that is still
+	# in flight.
+	download = downloads.get(article_file)
+	if download is not None:
+		success, etag = await asyncio.shield(download)
+
+		# Replace (rather than update) the entry since it may be 
+		# shared with the original article map.
+		if etag is not None and article_map[article].get("etag") != etag:
+			article_map[article] = {**article_map[article], "etag": etag}
+		if success:
+			existing_files.add(article_file)
+
+	# Skip this article if the local copy of the article is not 
 	# available (it very much should be at this point or else someone
 	# messed up the data pulled from download.py).
-	if not os.path.exists(article_path):
+	if article_file not in existing_files:
 		print(f"Error: Did not detect local file {article_path} for {article}")
 		print("Please make sure download.py has been run to completion before running this script.")
-		return article_submap, graph_submap
+		return 0
 	
 	###################################################################
 	# PARSE ARTICLE FOR RELATED DATA
 	###################################################################
 		
-	# Load local copy of the article and isolate all related terms and
-	# articles to the article.
-	with open(article_path, "r") as f:
-		soup = BeautifulSoup(f.read(), "lxml")
-
-	# List of outbound links for the current article (related terms and 
-	# articles).
-	outbound_links = list()
-
-	# Isolate related articles.
-	term_tags = soup.find_all(
-		'a', 
-		class_='related-terms__title mntl-text-link' 
-	)
-	outbound_links += [
-		(tag.text, tag["href"], True)
-		for tag in term_tags
-	]
-
-	# Isolate related terms.
-	article_tags = soup.find_all(
-		'a', 
-		class_='comp mntl-card-list-items mntl-document-card mntl-card related-articles__link card' 
+	# Parse the local copy of the article in the process pool to keep 
+	# the CPU bound work off of the event loop.
+	outbound_links = await parse_cached(pool, article_path)
+
+	# Skip this entry if the article was queued again with more depth 
+	# left while waiting on the download or parse. That entry shares 
+	# the same download and parse and will explore it instead.
+	if depth < visited.get(article, depth):
+		return 0
+
+	# Update graph. Outbound links are stored as a set so duplicates 
+	# are dropped as they are added.
+	graph[article].update(
+		new_article[0] for new_article in outbound_links
 	)
-	outbound_links += [
-		(
-			tag.find('span', class_='card__title-text').text, 
-			tag["href"], 
-			False
-		)
-		for tag in article_tags
-	]
-
-	# Update graph subgraph.
-	if article in graph_submap:
-		graph_submap[article] += [
-			new_article[0] for new_article in outbound_links
-		]
-	else:
-		graph_submap[article] = [
-			new_article[0] for new_article in outbound_links
-		]
 
 	###################################################################
 	# EXPLORE RELATED ARTICLES
 	###################################################################
 
-	# Continue exploring the links via recursive call if the depth is
-	# non-zero.
+	# Queue up the outbound links for exploration if the depth is 
+	# non-zero. Workers finish out of order, so an article reached by a
+	# longer path first is queued again if a shorter path reaches it 
+	# later with more depth left. The event loop is single threaded so
+	# the visited map needs no lock.
+	queued = 0
 	if depth > 0:
-		# Iterate through all found outbound links.
-		for outbound_link in outbound_links:
-			# Unpack the outbound like.
-			article_name, article_link, is_term = outbound_link
+		for article_name, article_link, is_term in outbound_links:
+			if visited.get(article_name, -1) >= depth - 1:
+				continue
 
-			# Implement the recursive call.
-			article_sub_submap, graph_sub_submap = explore_related(
+			visited[article_name] = depth - 1
+			queue.put_nowait(
+				(article_name, article_link, is_term, depth - 1)
+			)
+			queued += 1
+
+	return queued
+
+
+async def worker(
+	queue: asyncio.Queue,
+	session: RetryClient,
+	sem: asyncio.Semaphore,
+	pool: ProcessPoolExecutor,
+	robots: RobotFileParser,
+	article_map: Dict[str, Dict[str, str]],
+	graph: Dict[str, Set[str]],
+	visited: Dict[str, int],
+	existing_files: Set[str],
+	progress: tqdm,
+	restart: bool = False
+) -> None:
+	'''
+	Pull articles off of the queue and explore them. Runs until 
+		cancelled.
+	@param: queue (asyncio.Queue), the queue of (article, url, is_term,
+		depth) tuples left to explore.
+	@param: session (RetryClient), the shared HTTP session.
+	@param: sem (asyncio.Semaphore), the semaphore bounding the number
+		of concurrent requests.
+	@param: pool (ProcessPoolExecutor), the process pool that articles
+		are parsed in.
+	@param: robots (RobotFileParser), the parsed robots.txt that 
+		downloads must be allowed by.
+	@param: article_map (Dict[str, Dict[str, str]]), the mapping for
+		each article/entry and its associated local copy and url on 
+		investopedia.
+	@param: graph (Dict[str, Set[str]]), the mapping for each 
+		article/entry and its associated related terms and articles.
+	@param: visited (Dict[str, int]), the articles that have already
+		been queued for exploration, mapped to the largest depth they
+		were queued with.
+	@param: existing_files (Set[str]), the (normalized) paths of the
+		articles that exist locally.
+	@param: progress (tqdm), the progress bar over every article 
+		queued so far.
+	@param: restart (bool). whether to re-scrape the articles and 
+		update their local copies with the new data.
+	@return: returns nothing.
+	'''
+	while True:
+		article, article_url, is_term, depth = await queue.get()
+		try:
+			queued = await explore_related(
+				queue,
+				session,
+				sem,
+				pool,
+				robots,
 				article_map,
-				# graph,
-				article_name,
-				article_link,
+				graph,
+				visited,
+				existing_files,
+				article,
+				article_url,
 				is_term,
-				depth - 1,
+				depth,
 				restart
 			)
+			progress.total += queued
+		except Exception as e:
+			print(f"Error: Failed to explore {article}: {e}")
+		finally:
+			progress.update(1)
+			queue.task_done()
+
+
+async def explore_graph(
+	article_map: Dict[str, Dict[str, str]],
+	expanded_map: Dict[str, Dict[str, str]],
+	graph: Dict[str, Set[str]],
+	depth: int = 1,
+	restart: bool = False
+) -> bool:
+	'''
+	Explore the related terms and articles of every article in a 
+		breadth-first traversal, with a pool of workers downloading 
+		and parsing articles concurrently.
+	@param: article_map (Dict[str, Dict[str, str]]), the mapping for
+		each article/entry pulled with download.py.
+	@param: expanded_map (Dict[str, Dict[str, str]]), the mapping for
+		each article/entry that is expanded upon by the traversal.
+	@param: graph (Dict[str, Set[str]]), the mapping for each 
+		article/entry and its associated related terms and articles.
+	@param: depth (int), the level of depth that is to be explored in
+		this graph. Default is 1.
+	@param: restart (bool). whether to re-scrape the articles and 
+		update their local copies with the new data.
+	@return: returns a boolean as to whether the exploration ran (False
+		if the robots.txt could not be read). The expanded_map and 
+		graph are updated in place.
+	'''
+	queue = asyncio.Queue()
+	visited = dict()
 
-			# Update the subgraphs.
-			article_submap.update(article_sub_submap)
-			for graph_node, graph_values in graph_sub_submap.items():
-				if graph_node in graph_submap:
-					graph_submap[graph_node] += graph_values
-				else:
-					graph_submap[graph_node] = graph_values
-
-			# Memory cleanup.
-			del article_name
-			del article_link
-			del article_sub_submap
-			del graph_sub_submap
-			gc.collect()
-	
-	###################################################################
-	# AGGREGATE RELATED DATA
-	###################################################################
+	# Scan for the articles that already exist locally once up front 
+	# rather than checking for each file as it is explored.
+	existing_files = scan_existing_files("./data")
 
-	# Help reduce memory of graph.
-	for key, value in graph_submap.items():
-		graph_submap[key] = list(set(value))
+	# Queue up each article to explore its related links to other 
+	# terms and articles.
+	for article in article_map:
+		# Verify the local file exists.
+		article_path = article_map[article]["path"]
+		article_link = article_map[article]["link"]
+		if os.path.normpath(article_path) not in existing_files:
+			print(f"Could not find path {article_path}")
+			print(f"Skipping {article}")
+			continue
 
-	# Return the updated submaps.
-	return article_submap, graph_submap
+		# is_term is true for all values in article_map.
+		visited[article] = depth
+		queue.put_nowait((article, article_link, True, depth))
+
+	# Bound the number of requests in flight to stay at a rate the 
+	# server will sustain without throttling.
+	sem = asyncio.Semaphore(max_concurrent_requests)
+
+	async with create_session() as session:
+		# Only download the pages allowed by robots.txt.
+		robots = await get_robots(session)
+		if robots is None:
+			return False
+
+		# Track progress over every article queued, growing the total
+		# as the workers discover new articles.
+		progress = tqdm(total=queue.qsize(), desc="Graph expand")
+
+		# Articles are parsed across processes to get around the GIL.
+		with progress, ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+			# Spin up the workers and wait for the queue to drain. The 
+			# workers loop forever so cancel them once it does.
+			workers = [
+				asyncio.create_task(
+					worker(
+						queue, 
+						session, 
+						sem, 
+						pool,
+						robots,
+						expanded_map, 
+						graph, 
+						visited, 
+						existing_files,
+						progress,
+						restart
+					)
+				)
+				for _ in range(num_workers)
+			]
+			await queue.join()
+
+			for task in workers:
+				task.cancel()
+			await asyncio.gather(*workers, return_exceptions=True)
+
+	return True
 
 
 def main():
@@ -250,8 +557,8 @@ def main():
 		exit(1)
 
 	# Load articles.
-	with open(article_json, "r") as f:
-		article_map = json.load(f)
+	with open(article_json, "rb") as f:
+		article_map = orjson.loads(f.read())
 
 	# Initialize necessary folder paths if they don't already exist.
 	term_folder = "./data/term/"
@@ -266,63 +573,31 @@ def main():
 	###################################################################
 
 	# Clone article map. This will contain the expanded map information
-	# for articles (link and path). Initialize a graph to keep track of 
-	# which articles link together.
-	expanded_map = copy.deepcopy(article_map)
-	graph = {article: list() for article in article_map}
-
-	# Iterate through each article and recrusively explore its related
-	# links to other terms and articles.
-	for article in tqdm(list(article_map.keys())):
-		# Compute all visited links. Current placement in the code is
-		# not ideal.
-		# visited_links = [
-		# 	expanded_map[key]["link"] for key in expanded_map
-		# ]
-
-		# Verify the local file exists.
-		article_path = article_map[article]["path"]
-		article_link = article_map[article]["link"]
-		if not os.path.exists(article_path):
-			print(f"Could not find path {article_path}")
-			print(f"Skipping {article}")
-			continue
+	# for articles (link and path). A shallow copy is enough since 
+	# entries are only ever added or replaced, never mutated. 
+	# Initialize a graph to keep track of which articles link together.
+	expanded_map = dict(article_map)
+	graph = defaultdict(
+		set, 
+		{article: set() for article in article_map}
+	)
 
-		# Build out the graph by exploring the related terms and 
-		# articles.
-		article_submap, graph_submap = explore_related(
-			expanded_map, 
-			# graph, 
-			article, 
-			article_link,
-			True, # is_term is true for all values in article_map.
-			depth, 
-			restart
-		)
+	# Explore the related links of each article to other terms and 
+	# articles.
+	explored = asyncio.run(
+		explore_graph(article_map, expanded_map, graph, depth, restart)
+	)
 
-		# Update the graphs.
-		expanded_map.update(article_submap)
-		for graph_node, graph_value in graph_submap.items():
-			if graph_node in graph:
-				graph[graph_node] += graph_value
-			else:
-				graph[graph_node] = graph_value
-		
-		# Memory cleanup.
-		del article_path
-		del article_link
-		del article_submap
-		del graph_submap
-		gc.collect()
+	# Abort without writing partial graphs if nothing could be checked 
+	# against robots.txt.
+	if not explored:
+		print("Please try again once robots.txt can be retrieved.")
+		exit(1)
 
 	###################################################################
 	# AGGREGATE AND SAVE RELATED DATA
 	###################################################################
 	
-	# Help reduce memory of graph.
-	for key, value in graph.items():
-		graph[key] = list(set(value))
-
 	# Save the graphs.
 	expanded_json = os.path.join(
 		data_folder,
@@ -332,10 +607,13 @@ def main():
 		data_folder,
 		f"term_article_graph_depth{depth}.json"
 	)
-	with open(expanded_json, "w+") as f:
-		json.dump(expanded_map, f, indent=4)
-	with open(graph_json, "w+") as f:
-		json.dump(graph, f, indent=4)
+	# NOTE:
+	# The graph can grow very large so it is written without 
+	# indentation and streamed one node at a time.
+	with open(expanded_json, "wb") as f:
+		f.write(orjson.dumps(expanded_map, option=orjson.OPT_INDENT_2))
+	with open(graph_json, "wb") as f:
+		stream_dump_dict(graph, f)
 
 	# Exit the program.
 	exit(0)
@@ -5,14 +5,21 @@
 
 
 import argparse
-import json
+import asyncio
 import os
+from pathlib import Path
 import re
-from typing import List
+from typing import Awaitable, Dict, List, Optional, Tuple, TypeVar
+from urllib.robotparser import RobotFileParser
 
-from bs4 import BeautifulSoup
-import requests
-from tqdm import tqdm
+import aiohttp
+from aiohttp_retry import ExponentialRetry, RetryClient
+import orjson
+from selectolax.lexbor import LexborHTMLParser
+from tqdm.asyncio import tqdm_asyncio
+
+
+T = TypeVar("T")
 
 
 base_url = "https://www.investopedia.com/"
@@ -45,55 +52,317 @@ category_pages = [
 	"terms-beginning-with-y-4769375",
 	"terms-beginning-with-z-4769376",
 ]
-category_pattern = r"terms-beginning-with-(.*?)-\d+"
-article_pattern = r"\/([^\/]+)\.asp$"
+category_pattern = re.compile(r"terms-beginning-with-(.*?)-\d+")
+article_pattern = re.compile(r"\/([^\/]+)\.asp$")
+term_page_css = 'a.dictionary-top300-list__list.mntl-text-link'
+max_concurrent_requests = 20
+request_timeout = 15
+retry_statuses = {429, 500, 502, 503, 504}
+user_agent = "*"
+
+
+def create_session() -> RetryClient:
+	'''
+	Create the HTTP session shared across requests. Connections to the
+		host are pooled and kept alive between requests, responses may
+		be compressed, and requests time out instead of hanging. 
+		Requests that are throttled or hit a server error are retried
+		with exponential backoff.
+	@param: takes no arguments.
+	@return: returns the RetryClient wrapping the aiohttp.ClientSession
+		(must be created from within a running event loop).
+	'''
+	connector = aiohttp.TCPConnector(
+		limit=max_concurrent_requests, 
+		ttl_dns_cache=300
+	)
+	session = aiohttp.ClientSession(
+		connector=connector,
+		timeout=aiohttp.ClientTimeout(total=request_timeout),
+		headers={"Accept-Encoding": "gzip, deflate"}
+	)
+	retry_options = ExponentialRetry(
+		attempts=5,
+		start_timeout=0.5,
+		statuses=retry_statuses,
+		exceptions={aiohttp.ClientConnectionError, asyncio.TimeoutError}
+	)
+	return RetryClient(client_session=session, retry_options=retry_options)
 
 
-def get_articles_from_term_page(term_link: str) -> List[str]:
+async def get_robots(session: RetryClient) -> Optional[RobotFileParser]:
+	'''
+	Retrieve and parse the robots.txt for investopedia. Follows the 
+		same rules as RobotFileParser.read().
+	@param: session (RetryClient), the shared HTTP session.
+	@return: returns the RobotFileParser for investopedia, or None if 
+		the robots.txt could not be read at all.
+	'''
+	robots_link = base_url + "robots.txt"
+	robots = RobotFileParser(robots_link)
+
+	# Query the robots.txt.
+	try:
+		async with session.get(robots_link) as response:
+			return_status = response.status
+			if return_status == 200:
+				text = await response.text()
+				robots.parse(text.splitlines())
+				return robots
+	except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+		print(f"Request failed for {robots_link}: {e}")
+		return_status = None
+
+	if return_status in (401, 403):
+		robots.disallow_all = True
+	elif return_status is not None and 400 <= return_status < 500:
+		robots.allow_all = True
+	else:
+		print(f"Error: Could not read {robots_link}")
+		return None
+
+	return robots
+
+
+async def bounded(semaphore: asyncio.Semaphore, coroutine: Awaitable[T]) -> T:
+	'''
+	Await a coroutine while holding the semaphore, capping the number of
+		requests in flight at any one time.
+	@param: semaphore (asyncio.Semaphore), the semaphore bounding the
+		number of concurrent requests.
+	@param: coroutine (Awaitable[T]), the coroutine to await.
+	@return: returns the result of the coroutine.
+	'''
+	async with semaphore:
+		return await coroutine
+
+
+async def get_articles_from_term_page(
+	session: RetryClient, 
+	term_link: str
+) -> List[str]:
 	'''
 	Retrieve all article links from the term patch.
+	@param: session (RetryClient), the shared HTTP session.
 	@param: term_link (str), the URL of the term page.
 	@preturn: returns a list of links to key words from the term page.
 	'''
 	# Query the category/starting letter page.
-	response = requests.get(term_link)
-	return_status = response.status_code
-	if return_status != 200:
-		print(f"Request returned {return_status} status code for {term_link}")
+	try:
+		async with session.get(term_link) as response:
+			return_status = response.status
+			if return_status != 200:
+				print(f"Request returned {return_status} status code for {term_link}")
+				return []
+
+			text = await response.text()
+	except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+		print(f"Request failed for {term_link}: {e}")
 		return []
 
-	# Set up BeautifulSoup object.
-	soup = BeautifulSoup(response.text, "lxml")
+	# Set up the HTML parser.
+	tree = LexborHTMLParser(text)
 
 	# Isolate and return the article links.
-	article_links  = soup.find_all(
-		'a', 
-		class_='dictionary-top300-list__list mntl-text-link'
-	)
-	article_links = [link["href"] for link in article_links]
+	article_links = tree.css(term_page_css)
+	article_links = [
+		link.attributes.get("href") for link in article_links
+		if link.attributes.get("href")
+	]
 	return article_links
 
 
-def get_article(article_link: str, file_path: str) -> bool:
+async def get_article(
+	session: RetryClient, 
+	article_link: str, 
+	file_path: str,
+	restart: bool = False,
+	etag: Optional[str] = None
+) -> Tuple[bool, Optional[str]]:
 	'''
-	Download article (HTML) to file.
+	Download article (HTML) to file. The download is skipped if the 
+		file already exists, unless restarting. When restarting, the 
+		ETag of the local copy is sent so that an unchanged article is
+		not downloaded again.
+	@param: session (RetryClient), the shared HTTP session.
 	@param: article_link (str), the URL of the article.
 	@param: file_path (str), the path to the file.
-	@preturn: returns a boolean as to whether the download succeeded or
-		not.
+	@param: restart (bool), whether to re-download the article if it
+		already exists. Default is False.
+	@param: etag (Optional[str]), the ETag returned when the local copy
+		was downloaded. Default is None.
+	@preturn: returns a tuple containing a boolean as to whether the
+		article is available locally and the ETag of the local copy (if
+		any).
 	'''
+	# Skip the download if the article already exists locally.
+	if not restart and os.path.exists(file_path):
+		return True, etag
+
+	# Only ask the server to skip unchanged articles if there is a 
+	# local copy to fall back on.
+	headers = dict()
+	if etag is not None and os.path.exists(file_path):
+		headers["If-None-Match"] = etag
+
 	# Query the article page.
-	response = requests.get(article_link)
-	return_status = response.status_code
-	if return_status != 200:
-		print(f"Request returned {return_status} status code for {article_link}")
-		return False
+	try:
+		async with session.get(article_link, headers=headers) as response:
+			return_status = response.status
+			if return_status == 304:
+				# Article is unchanged since the local copy was saved.
+				return True, etag
+			if return_status != 200:
+				print(f"Request returned {return_status} status code for {article_link}")
+				return False, etag
+
+			content = await response.read()
+			etag = response.headers.get("ETag")
+	except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+		print(f"Request failed for {article_link}: {e}")
+		return False, etag
 	
-	# Output the article HTML content to file.
-	with open(file_path, "w+") as f:
-		f.write(response.text)
+	# Output the article HTML content to file. The raw bytes are written
+	# as is (no decode/encode round trip) and disk I/O is pushed to a 
+	# thread to keep it off the event loop.
+	await asyncio.to_thread(Path(file_path).write_bytes, content)
+
+	return True, etag
+
+
+async def download_articles(
+	restart: bool,
+	previous_map: Dict[str, Dict[str, str]]
+) -> Optional[Dict[str, Dict[str, str]]]:
+	'''
+	Download the articles from investopedia organized by starting 
+		character/number. Articles within a category are downloaded
+		concurrently over a shared session.
+	@param: restart (bool), whether to re-download articles that 
+		already exist locally.
+	@param: previous_map (Dict[str, Dict[str, str]]), the article map
+		saved from a prior run (used for the ETags of local copies).
+	@return: returns the mapping for each article to its local copy and
+		url on investopedia, or None if the robots.txt could not be 
+		read.
+	'''
+	# Root dir for data.
+	root_dir = "./data"
+	os.makedirs(root_dir, exist_ok=True)
+
+	# Map of all articles.
+	article_map = dict()
+
+	# Bound the number of requests in flight to stay at a rate the 
+	# server will sustain without throttling.
+	semaphore = asyncio.Semaphore(max_concurrent_requests)
+
+	async with create_session() as session:
+		# Only download the pages allowed by robots.txt.
+		robots = await get_robots(session)
+		if robots is None:
+			return None
 
-	return True
+		# Iterate through each category.
+		for category_link in category_pages:
+			# Extract directory name.
+			match = category_pattern.search(category_link)
+			if not match:
+				# NOTE:
+				# There are some good articles that are easy to scrape and
+				# download that do not match the above pattern. We will 
+				# consider these acceptable to not be captured upon the 
+				# initial scan.
+
+				# Skip if not found. 
+				print(f"Was not able to isolate name for {category_link}")
+				continue
+
+			name = match.group(1)
+			folder_path = os.path.join(
+				root_dir,
+				name
+			)
+			print(f"Processing articles in {name} category")
+
+			# Check for directory. Create if it doesn't exist.
+			if not os.path.exists(folder_path) or not os.path.isdir(folder_path):
+				os.makedirs(folder_path, exist_ok=True)
+
+			# Skip the category if robots.txt disallows it.
+			if not robots.can_fetch(user_agent, base_url + category_link):
+				print(f"Skipping {category_link}, disallowed by robots.txt")
+				continue
+
+			# Identify all articles for each term.
+			article_links = await get_articles_from_term_page(
+				session,
+				base_url + category_link
+			)
+
+			# Move along if the number of article links returned is 0 
+			# (sign of bad HTTP request response).
+			if len(article_links) == 0:
+				continue
+
+			# Collect the (name, url, path) of the articles to download.
+			downloads = list()
+			for article_link in article_links:
+				# Get article name.
+				match = article_pattern.search(article_link)
+				if not match:
+					# Skip if not found.
+					print(f"Was not able to isolate name for article {article_link}")
+					continue
+
+				# Skip if robots.txt disallows it.
+				if not robots.can_fetch(user_agent, article_link):
+					print(f"Skipping {article_link}, disallowed by robots.txt")
+					continue
+
+				name = match.group(1)
+				file_path = os.path.join(
+					folder_path,
+					name + ".html"
+				)
+				# print(name)
+				# print(file_path)
+
+				# Update article map.
+				article_map[name] = {
+					"path": file_path,
+					"link": article_link
+				}
+
+				# Carry over the ETag of the local copy.
+				etag = previous_map.get(name, dict()).get("etag")
+				if etag is not None:
+					article_map[name]["etag"] = etag
+
+				downloads.append((name, article_link, file_path))
+
+			# Download the articles concurrently. Articles that already
+			# exist are skipped unless --restart is specified.
+			results = await tqdm_asyncio.gather(*[
+				bounded(
+					semaphore, 
+					get_article(
+						session, 
+						link, 
+						path, 
+						restart, 
+						article_map[name].get("etag")
+					)
+				)
+				for name, link, path in downloads
+			])
+
+			# Record the ETags returned with the downloads.
+			for (name, _, _), (_, etag) in zip(downloads, results):
+				if etag is not None:
+					article_map[name]["etag"] = etag
+
+	return article_map
 
 
 def main():
@@ -114,86 +383,30 @@ def main():
 	)
 	args = parser.parse_args()
 
-	# Root dir for data.
-	root_dir = "./data"
-	os.makedirs(root_dir, exist_ok=True)
-
-	# Map of all articles.
-	article_map = dict()
-
-	# Iterate through each category.
-	for category_link in category_pages:
-		# Extract directory name.
-		match = re.search(category_pattern, category_link)
-		if not match:
-			# NOTE:
-			# There are some good articles that are easy to scrape and
-			# download that do not match the above pattern. We will 
-			# consider these acceptable to not be captured upon the 
-			# initial scan.
-
-			# Skip if not found. 
-			print(f"Was not able to isolate name for {category_link}")
-			continue
-
-		name = match.group(1)
-		folder_path = os.path.join(
-			root_dir,
-			name
-		)
-		print(f"Processing articles in {name} category")
-
-		# Check for directory. Create if it doesn't exist.
-		if not os.path.exists(folder_path) or not os.path.isdir(folder_path):
-			os.makedirs(folder_path, exist_ok=True)
-
-		# Identify all articles for each term.
-		article_links = get_articles_from_term_page(
-			base_url + category_link
-		)
-
-		# Move along if the number of article links returned is 0 (sign 
-		# of bad HTTP request response).
-		if len(article_links) == 0:
-			continue
-
-		# print(json.dumps(article_links, indent=4))
-
-		# Download remaining articles.
-		for article_link in tqdm(article_links):
-			# Get article name.
-			match = re.search(article_pattern, article_link)
-			if not match:
-				# Skip if not found.
-				print(f"Was not able to isolate name for article {article_link}")
-				continue
-
-			name = match.group(1)
-			file_path = os.path.join(
-				folder_path,
-				name + ".html"
-			)
-			# print(name)
-			# print(file_path)
+	# Load the article map from a prior run (if any).
+	graph_folder = "./graph"
+	file_path = os.path.join(graph_folder, "article_map.json")
+	previous_map = dict()
+	if os.path.exists(file_path):
+		with open(file_path, "rb") as f:
+			previous_map = orjson.loads(f.read())
 
-			# Update article map.
-			article_map[name] = {
-				"path": file_path,
-				"link": article_link
-			}
+	# Download the articles.
+	article_map = asyncio.run(
+		download_articles(args.restart, previous_map)
+	)
 
-			# Get article if --restart OR article does not already exist.
-			if args.restart or not os.path.exists(file_path):
-				# Download article.
-				get_article(article_link, file_path)
+	# Abort without overwriting the existing article map (and its 
+	# ETags) if nothing could be checked against robots.txt.
+	if article_map is None:
+		print("Please try again once robots.txt can be retrieved.")
+		exit(1)
 
 	# Save the article map.
-	graph_folder = "./graph"
-	file_path = os.path.join(graph_folder, "article_map.json")
 	if not os.path.exists(graph_folder):
 		os.makedirs(graph_folder)
-	with open(file_path, "w+") as f:
-		json.dump(article_map, f, indent=4)
+	with open(file_path, "wb") as f:
+		f.write(orjson.dumps(article_map, option=orjson.OPT_INDENT_2))
 
 	# Exit the program.
 	exit(0)
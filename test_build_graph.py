@@ -0,0 +1,128 @@
+# test_build_graph.py
+# Regression tests for the graph traversal in build_graph.py, run
+# against a local server.
+# Python 3.11
+# Windows/MacOS/Linux
+
+
+import asyncio
+from collections import defaultdict
+import os
+import tempfile
+import unittest
+
+from aiohttp import web
+
+import build_graph
+import download
+
+
+# Outbound links and response delay (in seconds) for each page served.
+pages = {
+	"s1": (["a"], 0),
+	"s2": (["p"], 0),
+	"a": (["b"], 0),
+	"b": (["x"], 0),
+	"p": (["x"], 0.5),
+	"x": (["y"], 1.5),
+	"y": ([], 0),
+}
+
+
+def render(links):
+	'''
+	Render a page with a related term link for each outbound link.
+	@param: links (List[str]), the names of the linked pages.
+	@return: returns the HTML of the page.
+	'''
+	anchors = "".join(
+		f'<a class="related-terms__title mntl-text-link" href="{download.base_url}{link}.asp">{link}</a>'
+		for link in links
+	)
+	return f"<html><body>{anchors}</body></html>"
+
+
+class TestExploreGraph(unittest.IsolatedAsyncioTestCase):
+	async def asyncSetUp(self):
+		# Work out of a temporary directory since the data paths are
+		# relative.
+		self.cwd = os.getcwd()
+		self.tmp = tempfile.TemporaryDirectory()
+		os.chdir(self.tmp.name)
+
+		# Serve the pages, counting the requests for each.
+		self.hits = defaultdict(int)
+		app = web.Application()
+		app.router.add_get("/robots.txt", self.robots)
+		app.router.add_get("/{name}.asp", self.page)
+		self.runner = web.AppRunner(app)
+		await self.runner.setup()
+		site = web.TCPSite(self.runner, "127.0.0.1", 0)
+		await site.start()
+		port = self.runner.addresses[0][1]
+
+		self.base_url = download.base_url
+		download.base_url = f"http://127.0.0.1:{port}/"
+		build_graph.parse_cache.clear()
+		build_graph.downloads.clear()
+
+		# Seed the article map with local copies of the seed pages.
+		os.makedirs("./data/s", exist_ok=True)
+		os.makedirs("./data/term", exist_ok=True)
+		os.makedirs("./data/article", exist_ok=True)
+		self.article_map = dict()
+		for seed in ("s1", "s2"):
+			path = os.path.join("./data", "s", seed + ".html")
+			with open(path, "w") as f:
+				f.write(render(pages[seed][0]))
+			self.article_map[seed] = {
+				"path": path,
+				"link": f"{download.base_url}{seed}.asp"
+			}
+
+	async def asyncTearDown(self):
+		await self.runner.cleanup()
+		download.base_url = self.base_url
+		os.chdir(self.cwd)
+		self.tmp.cleanup()
+
+	async def robots(self, request):
+		return web.Response(text="User-agent: *\nAllow: /\n")
+
+	async def page(self, request):
+		name = request.match_info["name"]
+		self.hits[name] += 1
+		links, delay = pages[name]
+		await asyncio.sleep(delay)
+		return web.Response(text=render(links), content_type="text/html")
+
+	async def explore(self, restart):
+		expanded_map = dict(self.article_map)
+		graph = defaultdict(
+			set,
+			{article: set() for article in self.article_map}
+		)
+		explored = await build_graph.explore_graph(
+			self.article_map, expanded_map, graph, 3, restart
+		)
+		self.assertTrue(explored)
+		return graph
+
+	async def test_requeue_while_downloading(self):
+		# x is first queued at depth 0 (s1 -> a -> b -> x) and is still
+		# downloading when it is queued again at depth 1 (s2 -> p -> x),
+		# so its links must still be explored.
+		graph = await self.explore(restart=False)
+		self.assertEqual(graph["x"], {"y"})
+		self.assertIn("y", graph)
+		self.assertEqual(self.hits["x"], 1)
+
+	async def test_requeue_while_downloading_restart(self):
+		graph = await self.explore(restart=True)
+		self.assertEqual(graph["x"], {"y"})
+		self.assertIn("y", graph)
+		self.assertEqual(self.hits["x"], 1)
+
+
+if __name__ == '__main__':
+	unittest.main()